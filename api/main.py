@@ -1,12 +1,17 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, validator
-from typing import Literal, Optional, List, Dict, Any
-from datetime import datetime, timedelta
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated, Literal, Optional, List, Dict, Any, Tuple
+from datetime import datetime
+from collections import deque
+from cachetools import LRUCache, TLRUCache
 import os
+import hashlib
 import logging
 import asyncio
 import httpx
+import orjson
 
 app = FastAPI(title="Relic Recon API")
 
@@ -21,30 +26,41 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["content-type", "authorization", "if-none-match"],
+    # cross-origin JS can only read the /triage ETag if it is exposed
+    expose_headers=["ETag"],
 )
 
-# Logging
-logging.basicConfig(level=logging.INFO)
+# Logging (LOG_LEVEL=WARNING in prod drops per-request cache-hit records)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_level = logging.getLevelName(LOG_LEVEL)  # int for known names, a str otherwise
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO", LOG_LEVEL)
 
-# In-memory cache
-cache: Dict[str, tuple[Any, datetime]] = {}
-CACHE_TTL = timedelta(minutes=15)
+# In-memory cache: TTL (seconds) matched to how volatile each endpoint's data is
+CACHE_POLICIES = {"health": 2, "triage_stub": 3600, "triage_nvd": 300}
+TRIAGE_POLICY = "triage_stub" if STUB_MODE else "triage_nvd"
+
+def _cache_ttu(key: str, value: Any, now: float) -> float:
+    # keys are prefixed with their policy name; expiry is on time.monotonic()
+    return now + CACHE_POLICIES[key.split(":", 1)[0]]
+
+cache: TLRUCache = TLRUCache(maxsize=1024, ttu=_cache_ttu)
+# Last good /triage response per key, never expired; served when NVD is down
+stale_cache: LRUCache = LRUCache(maxsize=512)
+# In-progress /triage fetches by cache key, for request coalescing
+_inflight: Dict[str, asyncio.Future] = {}
 MAX_RESPONSE_SIZE = 200 * 1024  # 200KB
 
 class TriageRequest(BaseModel):
-    target: str = Field(..., min_length=1)
+    # stripped before the length check, so whitespace-only targets are rejected
+    target: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
     depth: Literal["quick", "standard"] = "quick"
     include_enrichment: bool = True
 
-    @validator("target")
-    def validate_target(cls, v):
-        if not v or not v.strip():
-            raise ValueError("Target cannot be empty")
-        return v.strip()
-
 class TriageResponse(BaseModel):
     assets: List[str]
     tech: List[str]
@@ -53,16 +69,15 @@ class TriageResponse(BaseModel):
     checks: List[str]
     sources: List[Dict[str, str]]
 
-def get_cached(key: str) -> Optional[Any]:
-    if key in cache:
-        data, timestamp = cache[key]
-        if datetime.now() - timestamp < CACHE_TTL:
-            return data
-        del cache[key]
-    return None
-
-def set_cached(key: str, data: Any):
-    cache[key] = (data, datetime.now())
+# Static parts of every brief, shared across responses
+CHECKS = (
+    "Verify CVE applicability to in-scope assets",
+    "Review exposed configurations (passive only)",
+    "Check TLS/headers and CSP",
+    "Enumerate subdomains (passive)",
+)
+CVE_SOURCE = "stub-cve" if STUB_MODE else "nvd"
+GITHUB_SOURCE = "stub-github"
 
 async def mock_cve_search(target: str, limit: int = 10) -> List[Dict[str, Any]]:
     """Mock CVE search for dry-run/local dev"""
@@ -89,17 +104,42 @@ async def mock_github_search(target: str, limit: int = 10) -> List[Dict[str, Any
         for i in range(min(2, limit))
     ]
 
+# Shared upstream client: one connection pool for the app lifetime
+@app.on_event("startup")
+async def startup():
+    app.state.http = httpx.AsyncClient(
+        timeout=8.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+        # NVD JSON compresses well; httpx decodes gzip, and br via brotli
+        headers={"Accept-Encoding": "gzip, br", "User-Agent": "relic-recon/1.0"},
+    )
+    app.state.evidence_flusher = asyncio.create_task(_evidence_flusher())
+
+@app.on_event("shutdown")
+async def shutdown():
+    await _stop_evidence_flusher(app.state.evidence_flusher)
+    await app.state.http.aclose()
+
 #NVD helper functions
-async def _http_get_json(url: str, params: dict, headers: dict, size_cap: int = 200_000, timeout: float = 8.0):
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.get(url, params=params, headers=headers)
+_SEV_MAP = {"CRITICAL": "Critical", "HIGH": "High", "MEDIUM": "Medium", "LOW": "Low", "NONE": "None"}
+
+async def _http_get_json(client: httpx.AsyncClient, url: str, params: dict, headers: dict, size_cap: int = 200_000, timeout: float = 8.0):
+    async with client.stream("GET", url, params=params, headers=headers, timeout=timeout) as r:
         r.raise_for_status()
+        # content-length is only a hint (absent on chunked replies), so the
+        # running byte count below is what actually enforces the cap
         cl = r.headers.get("content-length")
         if cl and cl.isdigit() and int(cl) > size_cap:
             raise HTTPException(502, "Upstream too large")
-        return r.json()
+        buf = bytearray()
+        async for chunk in r.aiter_bytes():
+            buf.extend(chunk)
+            if len(buf) > size_cap:
+                raise HTTPException(502, "Upstream too large")
+    return orjson.loads(buf)
 
-async def _lookup_cves_nvd(keyword: str, limit: int):
+async def _lookup_cves_nvd(client: httpx.AsyncClient, keyword: str, limit: int):
     """
     Low-data CVE lookup via NVD v2 API. Hard-capped results + brief fields.
     Works without NVD_API_KEY, but the key improves rate limits.
@@ -110,107 +150,244 @@ async def _lookup_cves_nvd(keyword: str, limit: int):
         "resultsPerPage": max(1, min(limit, 10)),  # hard cap for data use
     }
     data = await _http_get_json(
+        client,
         "https://services.nvd.nist.gov/rest/json/cves/2.0",
         params=params,
         headers=headers,
     )
     items = []
-    for v in data.get("vulnerabilities", []):
-        c = v.get("cve", {})
-        cve_id = c.get("id")
-        descs = c.get("descriptions", [])
-        summary = (descs[0]["value"] if descs else "N/A")[:240]
-        metrics = c.get("metrics", {})
+    # direct indexing: every NVD record has these fields, so the happy path
+    # skips the .get() chains and only malformed records hit the except
+    for v in data.get("vulnerabilities", ()):
+        try:
+            c = v["cve"]
+            cve_id = c["id"]
+        except KeyError:
+            continue  # nothing to identify it by in the brief
+        try:
+            summary = c["descriptions"][0]["value"][:240]
+        except (KeyError, IndexError):
+            summary = "N/A"
         cvss, severity = 0.0, "Unknown"
-        if "cvssMetricV31" in metrics:
-            m = metrics["cvssMetricV31"][0]
-            cvss = m.get("cvssData", {}).get("baseScore", 0.0)
-            severity = m.get("baseSeverity", "Unknown").title()
-        elif "cvssMetricV2" in metrics:
-            m = metrics["cvssMetricV2"][0]
-            cvss = m.get("cvssData", {}).get("baseScore", m.get("baseScore", 0.0))
-            severity = "High" if cvss and float(cvss) >= 7 else "Medium"
+        try:
+            metrics = c["metrics"]
+            if "cvssMetricV31" in metrics:
+                d = metrics["cvssMetricV31"][0]["cvssData"]
+                cvss = d["baseScore"]
+                severity = _SEV_MAP.get(d["baseSeverity"], "Unknown")
+            elif "cvssMetricV2" in metrics:
+                m = metrics["cvssMetricV2"][0]
+                try:
+                    cvss = m["cvssData"]["baseScore"]
+                except KeyError:
+                    cvss = m.get("baseScore", 0.0)  # older records score the metric itself
+                severity = "High" if cvss and float(cvss) >= 7 else "Medium"
+        except (KeyError, IndexError):
+            pass
         items.append({"cve_id": cve_id, "cvss": cvss or 0.0, "summary": summary, "severity": severity})
+        if len(items) >= limit:
+            break  # don't trust upstream to honour resultsPerPage
     return items
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
+    # micro-cache: cheap endpoint, but polled hard
+    body = cache.get("health")
+    if body is None:
+        body = orjson.dumps({"status": "ok", "timestamp": datetime.utcnow().isoformat()})
+        cache["health"] = body
+    return Response(content=body, media_type="application/json")
 
-@app.post("/triage", response_model=TriageResponse)
+# TriageResponse documents the shape; payloads are plain dicts sent via orjson
+# so FastAPI skips the response_model validation pass
+@app.post("/triage", response_model=None, response_class=ORJSONResponse,
+          responses={200: {"model": TriageResponse}})
 async def triage(request: TriageRequest, req: Request):
-    # include the mode in the cache key so stub/real don’t mix
-    cache_key = f"{request.target}:{request.depth}:{request.include_enrichment}:{'stub' if STUB_MODE else 'nvd'}"
+    # policy prefix carries the mode, so stub/real don’t mix and each gets its own TTL
+    cache_key = f"{TRIAGE_POLICY}:{request.target}:{request.depth}:{request.include_enrichment}"
 
     # cache check keeps bandwidth tiny
     if LOW_DATA:
-        cached = get_cached(cache_key)
+        cached = cache.get(cache_key)
         if cached:
-            logger.info(f"Cache hit for {request.target}")
-            return cached
+            logger.info("Cache hit for %s", request.target)
+            return _json_response(*cached, req)
+
+    # single-flight: concurrent misses on one key share a single upstream fetch
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_run_triage(request, req.app, cache_key))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _forget_inflight(cache_key, t))
 
     try:
-        # smaller caps in LOW_DATA, slightly larger otherwise
-        limit = 5 if request.depth == "quick" else MAX_RESULTS
-        timeout = 10 if request.depth == "quick" else 20
-
-        if STUB_MODE:
-            # no external calls
-            cves_task = asyncio.create_task(mock_cve_search(request.target, limit))
-            github_task = asyncio.create_task(mock_github_search(request.target, limit))
-            cves, github_results = await asyncio.wait_for(
-                asyncio.gather(cves_task, github_task),
-                timeout=timeout
-            )
-            sources = [
-                {"tool": "stub-cve", "timestamp": datetime.utcnow().isoformat()},
-                {"tool": "stub-github", "timestamp": datetime.utcnow().isoformat()},
-            ]
-        else:
-            # one small, capped NVD request; exposures still mocked
-            cves = await asyncio.wait_for(_lookup_cves_nvd(request.target, limit), timeout=timeout)
-            github_results = await asyncio.wait_for(mock_github_search(request.target, 2), timeout=timeout)
-            sources = [
-                {"tool": "nvd", "timestamp": datetime.utcnow().isoformat()},
-                {"tool": "stub-github", "timestamp": datetime.utcnow().isoformat()},
-            ]
-
-        response = TriageResponse(
-            assets=[request.target],
-            tech=["Unknown"],
-            cves=cves[:8],  # UI safety cap
-            exposures=[r["snippet"] for r in github_results],
-            checks=[
-                "Verify CVE applicability to in-scope assets",
-                "Review exposed configurations (passive only)",
-                "Check TLS/headers and CSP",
-                "Enumerate subdomains (passive)",
-            ],
-            sources=sources,
-        )
-
-        if LOW_DATA:
-            set_cached(cache_key, response)
-
-        log_evidence(request.target, response)
-        return response
-
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="Request timeout")
+        # shield: one caller disconnecting must not cancel the others' fetch
+        body, etag = await asyncio.shield(task)
+        return _json_response(body, etag, req)
+
+    except (asyncio.TimeoutError, httpx.HTTPError) as e:
+        # upstream down or slow: serve the last good brief rather than an error
+        stale = _stale_response(cache_key)
+        if stale is not None:
+            logger.warning("Serving stale triage for %s: %r", request.target, e)
+            return ORJSONResponse(stale)
+        if isinstance(e, asyncio.TimeoutError):
+            raise HTTPException(status_code=504, detail="Request timeout")
+        logger.error("Triage error: %s", e)
+        raise HTTPException(status_code=502, detail="Upstream service error")
     except Exception as e:
-        logger.error(f"Triage error: {e}")
+        logger.error("Triage error: %s", e)
         raise HTTPException(status_code=502, detail="Upstream service error")
 
-def log_evidence(target: str, response: TriageResponse):
-    """Log MCP call metadata to evidence.log with rotation"""
-    log_file = "api/evidence.log"
-    max_size = 1024 * 1024  # 1MB
-    
-    try:
-        if os.path.exists(log_file) and os.path.getsize(log_file) > max_size:
-            os.rename(log_file, f"{log_file}.{datetime.now().strftime('%Y%m%d%H%M%S')}")
-        
-        with open(log_file, "a") as f:
-            f.write(f"{datetime.utcnow().isoformat()} | {target} | {len(response.cves)} CVEs | {len(response.exposures)} exposures\n")
-    except Exception as e:
-        logger.error(f"Evidence logging error: {e}")
+async def _run_triage(request: TriageRequest, app: FastAPI, cache_key: str) -> Tuple[bytes, str]:
+    """Fetch, build and cache one brief; returns the encoded body and its ETag"""
+    # once per upstream fetch: shared by sources and the evidence line
+    ts = datetime.utcnow().isoformat()
+    # smaller caps in LOW_DATA, slightly larger otherwise; never more than the
+    # UI's 8 CVEs, so the helpers return an already-capped list
+    limit = min(5 if request.depth == "quick" else MAX_RESULTS, 8)
+    timeout = 10 if request.depth == "quick" else 20
+
+    if STUB_MODE:
+        # no external calls
+        cve_coro = mock_cve_search(request.target, limit)
+        gh_coro = mock_github_search(request.target, limit)
+    else:
+        # one small, capped NVD request; exposures still mocked
+        cve_coro = _lookup_cves_nvd(app.state.http, request.target, limit)
+        gh_coro = mock_github_search(request.target, 2)
+
+    # gather schedules both; NVD latency overlaps the exposure lookup
+    cves, github_results = await asyncio.wait_for(
+        asyncio.gather(cve_coro, gh_coro),
+        timeout=timeout
+    )
+
+    payload = {
+        "assets": [request.target],
+        "tech": ["Unknown"],
+        "cves": cves,
+        "exposures": [r["snippet"] for r in github_results],
+        "checks": CHECKS,
+        "sources": [
+            {"tool": CVE_SOURCE, "timestamp": ts},
+            {"tool": GITHUB_SOURCE, "timestamp": ts},
+        ],
+    }
+
+    # encode once; cache hits replay these bytes as-is
+    body = orjson.dumps(payload)
+    etag = _etag(body)
+    if LOW_DATA:
+        cache[cache_key] = (body, etag)
+    stale_cache[cache_key] = payload
+
+    log_evidence(request.target, payload, ts)
+    return body, etag
+
+def _forget_inflight(cache_key: str, task: asyncio.Future):
+    _inflight.pop(cache_key, None)
+    if not task.cancelled():
+        task.exception()  # awaiting callers handle it; don't warn if none are left
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak If-None-Match comparison: W/ prefixes ignored, lists and * honoured"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+def _json_response(body: bytes, etag: str, req: Request) -> Response:
+    """200 with an ETag, or an empty 304 if the client already holds this body"""
+    if _etag_matches(req.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+def _stale_response(cache_key: str) -> Optional[Dict[str, Any]]:
+    """Last good payload for this key, with the NVD source flagged stale"""
+    stale = stale_cache.get(cache_key)
+    if stale is None:
+        return None
+    sources = [
+        {**s, "stale": "true"} if s["tool"] == "nvd" else s
+        for s in stale["sources"]
+    ]
+    return {**stale, "sources": sources}
+
+# Evidence log: lines are buffered and written in batches by a background task
+EVIDENCE_LOG = "api/evidence.log"
+EVIDENCE_MAX_SIZE = 1024 * 1024  # 1MB
+EVIDENCE_FLUSH_LINES = 100
+EVIDENCE_FLUSH_INTERVAL = 30  # seconds
+EVIDENCE_BUF_MAX = 10_000  # lines held while the flusher is behind or not running
+_evidence_buf: deque = deque()
+_evidence_lock = asyncio.Lock()
+_evidence_wake = asyncio.Event()
+_evidence_stopping = False
+# running size of evidence.log; stat once here instead of on every flush
+_evidence_bytes = os.path.getsize(EVIDENCE_LOG) if os.path.exists(EVIDENCE_LOG) else 0
+
+def log_evidence(target: str, payload: Dict[str, Any], ts: str):
+    """Queue MCP call metadata for evidence.log (written by the flusher)"""
+    if len(_evidence_buf) >= EVIDENCE_BUF_MAX:
+        logger.warning("Evidence buffer full, dropping line for %s", target)
+        return
+    _evidence_buf.append(f"{ts} | {target} | {len(payload['cves'])} CVEs | {len(payload['exposures'])} exposures\n")
+    if len(_evidence_buf) >= EVIDENCE_FLUSH_LINES:
+        _evidence_wake.set()
+
+async def _flush_evidence():
+    """Drain buffered evidence lines into evidence.log in one write, with rotation"""
+    async with _evidence_lock:
+        if not _evidence_buf:
+            return
+        lines = [_evidence_buf.popleft() for _ in range(len(_evidence_buf))]
+        try:
+            # disk stalls happen in a worker thread, not on the event loop
+            await asyncio.to_thread(_write_evidence, "".join(lines))
+        except Exception as e:
+            logger.error("Evidence logging error: %s", e)
+
+def _write_evidence(data: str):
+    """Blocking rotate + append; only called via asyncio.to_thread"""
+    global _evidence_bytes
+    if _evidence_bytes > EVIDENCE_MAX_SIZE:
+        # confirm on disk before rotating: logrotate, an operator or another
+        # worker may already have moved the file; one stat per batch at most
+        try:
+            _evidence_bytes = os.stat(EVIDENCE_LOG).st_size
+        except FileNotFoundError:
+            _evidence_bytes = 0
+        if _evidence_bytes > EVIDENCE_MAX_SIZE:
+            os.rename(EVIDENCE_LOG, f"{EVIDENCE_LOG}.{datetime.now().strftime('%Y%m%d%H%M%S')}")
+            _evidence_bytes = 0
+
+    encoded = data.encode()
+    with open(EVIDENCE_LOG, "ab") as f:
+        f.write(encoded)
+    _evidence_bytes += len(encoded)
+
+async def _evidence_flusher():
+    """Flush every EVIDENCE_FLUSH_INTERVAL seconds, or sooner once the buffer fills"""
+    while not _evidence_stopping:
+        try:
+            await asyncio.wait_for(_evidence_wake.wait(), timeout=EVIDENCE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _evidence_wake.clear()
+        await _flush_evidence()
+
+async def _stop_evidence_flusher(flusher: asyncio.Task):
+    """Let the flusher finish its current write and exit, then drain what's left.
+    Not cancelled: that would release the lock while a write thread still runs."""
+    global _evidence_stopping
+    _evidence_stopping = True
+    _evidence_wake.set()
+    await flusher
+    await _flush_evidence()
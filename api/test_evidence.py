@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+
+PAYLOAD = {"cves": [{}], "exposures": []}
+
+
+@pytest.fixture
+def evidence(monkeypatch, tmp_path):
+    """Evidence log pointed at a temp file, with fresh buffer/loop primitives."""
+    log_file = tmp_path / "evidence.log"
+    monkeypatch.setattr(main, "EVIDENCE_LOG", str(log_file))
+    monkeypatch.setattr(main, "_evidence_bytes", 0)
+    monkeypatch.setattr(main, "_evidence_stopping", False)
+    monkeypatch.setattr(main, "_evidence_lock", asyncio.Lock())
+    monkeypatch.setattr(main, "_evidence_wake", asyncio.Event())
+    main._evidence_buf.clear()
+    yield log_file
+    main._evidence_buf.clear()
+
+
+def count_writes(monkeypatch, delay: float = 0.0):
+    """Wrap _write_evidence to record calls and the peak number running at once."""
+    stats = {"calls": 0, "active": 0, "peak": 0}
+    lock = threading.Lock()
+    real = main._write_evidence
+
+    def wrapped(data: str):
+        with lock:
+            stats["calls"] += 1
+            stats["active"] += 1
+            stats["peak"] = max(stats["peak"], stats["active"])
+        try:
+            time.sleep(delay)
+            real(data)
+        finally:
+            with lock:
+                stats["active"] -= 1
+
+    monkeypatch.setattr(main, "_write_evidence", wrapped)
+    return stats
+
+
+@pytest.mark.asyncio
+async def test_lines_are_written_in_one_batch(evidence, monkeypatch):
+    monkeypatch.setattr(main, "EVIDENCE_FLUSH_LINES", 3)
+    monkeypatch.setattr(main, "EVIDENCE_FLUSH_INTERVAL", 60)
+    stats = count_writes(monkeypatch)
+    flusher = asyncio.create_task(main._evidence_flusher())
+
+    main.log_evidence("a.example", PAYLOAD, "t1")
+    main.log_evidence("b.example", PAYLOAD, "t2")
+    await asyncio.sleep(0.05)
+    assert not evidence.exists()  # below the batch size, nothing written yet
+
+    main.log_evidence("c.example", PAYLOAD, "t3")
+    await asyncio.sleep(0.05)
+    assert stats["calls"] == 1
+    assert evidence.read_text().splitlines() == [
+        "t1 | a.example | 1 CVEs | 0 exposures",
+        "t2 | b.example | 1 CVEs | 0 exposures",
+        "t3 | c.example | 1 CVEs | 0 exposures",
+    ]
+
+    await main._stop_evidence_flusher(flusher)
+
+
+@pytest.mark.asyncio
+async def test_shutdown_drains_without_a_concurrent_write(evidence, monkeypatch):
+    monkeypatch.setattr(main, "EVIDENCE_FLUSH_LINES", 1)
+    stats = count_writes(monkeypatch, delay=0.1)
+    flusher = asyncio.create_task(main._evidence_flusher())
+
+    main.log_evidence("a.example", PAYLOAD, "t1")
+    await asyncio.sleep(0.02)  # flusher is now inside the slow threaded write
+    main.log_evidence("b.example", PAYLOAD, "t2")
+    await main._stop_evidence_flusher(flusher)
+
+    assert flusher.done()
+    assert stats["peak"] == 1
+    assert [line.split(" | ")[1] for line in evidence.read_text().splitlines()] == ["a.example", "b.example"]
+    assert not main._evidence_buf
+
+
+def test_full_buffer_drops_new_lines(evidence, monkeypatch, caplog):
+    monkeypatch.setattr(main, "EVIDENCE_BUF_MAX", 2)
+    for target in ("a.example", "b.example", "c.example"):
+        main.log_evidence(target, PAYLOAD, "t")
+
+    assert len(main._evidence_buf) == 2
+    assert "Evidence buffer full" in caplog.text
+
+
+def test_rotation_moves_an_oversized_log_aside(evidence):
+    evidence.write_bytes(b"x" * (main.EVIDENCE_MAX_SIZE + 1))
+    main._evidence_bytes = main.EVIDENCE_MAX_SIZE + 1
+
+    main._write_evidence("new line\n")
+
+    rotated = [p for p in evidence.parent.iterdir() if p.name.startswith("evidence.log.")]
+    assert len(rotated) == 1
+    assert evidence.read_text() == "new line\n"
+    assert main._evidence_bytes == len("new line\n")
+
+
+def test_rotation_survives_a_log_already_moved_away(evidence):
+    # counter says "rotate", but logrotate/another worker already took the file
+    main._evidence_bytes = main.EVIDENCE_MAX_SIZE + 1
+
+    main._write_evidence("first\n")
+    main._write_evidence("second\n")
+
+    assert evidence.read_text() == "first\nsecond\n"
+    assert main._evidence_bytes == len("first\nsecond\n")
+    assert list(evidence.parent.iterdir()) == [evidence]
+
+
+def test_rotation_skipped_when_the_log_on_disk_is_small(evidence):
+    evidence.write_text("kept\n")
+    main._evidence_bytes = main.EVIDENCE_MAX_SIZE + 1
+
+    main._write_evidence("more\n")
+
+    assert evidence.read_text() == "kept\nmore\n"
+    assert main._evidence_bytes == len("kept\nmore\n")
@@ -0,0 +1,215 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+import pytest_asyncio
+from cachetools import TLRUCache
+from fastapi.testclient import TestClient
+
+import main
+
+NVD_BODY = {
+    "vulnerabilities": [
+        {
+            "cve": {
+                "id": "CVE-2024-0001",
+                "descriptions": [{"lang": "en", "value": "Example issue"}],
+                "metrics": {"cvssMetricV31": [{"cvssData": {"baseScore": 9.8, "baseSeverity": "CRITICAL"}}]},
+            }
+        }
+    ]
+}
+
+
+@pytest_asyncio.fixture
+async def nvd(monkeypatch):
+    """Real-mode app whose NVD upstream is an httpx.MockTransport.
+
+    Set ``state["handler"]`` to change how the upstream answers; ``state["calls"]``
+    counts upstream requests.
+    """
+    monkeypatch.setattr(main, "STUB_MODE", False)
+    monkeypatch.setattr(main, "TRIAGE_POLICY", "triage_nvd")
+    monkeypatch.setattr(main, "CVE_SOURCE", "nvd")
+    monkeypatch.setattr(main, "LOW_DATA", True)
+    main.cache.clear()
+    main.stale_cache.clear()
+    main._inflight.clear()
+    main._evidence_buf.clear()
+
+    state = {"calls": 0, "handler": lambda request: httpx.Response(200, json=NVD_BODY)}
+
+    async def transport(request: httpx.Request) -> httpx.Response:
+        state["calls"] += 1
+        await asyncio.sleep(0.05)  # hold the fetch open so concurrent misses overlap
+        return state["handler"](request)
+
+    mock_client = httpx.AsyncClient(transport=httpx.MockTransport(transport))
+    monkeypatch.setattr(main.app.state, "http", mock_client, raising=False)
+    yield state
+    await mock_client.aclose()
+    main._evidence_buf.clear()
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Stub-mode app with LOW_DATA caching and empty caches."""
+    monkeypatch.setattr(main, "STUB_MODE", True)
+    monkeypatch.setattr(main, "TRIAGE_POLICY", "triage_stub")
+    monkeypatch.setattr(main, "CVE_SOURCE", "stub-cve")
+    monkeypatch.setattr(main, "LOW_DATA", True)
+    main.cache.clear()
+    main.stale_cache.clear()
+    main._evidence_buf.clear()
+    yield TestClient(main.app)
+    main._evidence_buf.clear()
+
+
+def api_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_upstream_call(nvd):
+    async with api_client() as client:
+        responses = await asyncio.gather(
+            *(client.post("/triage", json={"target": "example.com"}) for _ in range(10))
+        )
+
+    assert nvd["calls"] == 1
+    assert all(r.status_code == 200 for r in responses)
+    assert len({r.content for r in responses}) == 1
+    assert responses[0].json()["cves"][0]["cve_id"] == "CVE-2024-0001"
+    assert not main._inflight
+
+
+@pytest.mark.asyncio
+async def test_upstream_error_serves_stale_response(nvd):
+    async with api_client() as client:
+        fresh = await client.post("/triage", json={"target": "example.com"})
+        assert fresh.status_code == 200
+
+        main.cache.clear()  # fresh entry expired
+        nvd["handler"] = lambda request: httpx.Response(503)
+        stale = await client.post("/triage", json={"target": "example.com"})
+
+    assert stale.status_code == 200
+    body = stale.json()
+    assert body["cves"] == fresh.json()["cves"]
+    nvd_source = next(s for s in body["sources"] if s["tool"] == "nvd")
+    assert nvd_source["stale"] == "true"
+
+
+@pytest.mark.asyncio
+async def test_upstream_error_without_stale_entry_is_502(nvd):
+    nvd["handler"] = lambda request: httpx.Response(503)
+    async with api_client() as client:
+        r = await client.post("/triage", json={"target": "example.com"})
+
+    assert r.status_code == 502
+
+
+@pytest.mark.asyncio
+async def test_oversize_chunked_upstream_body_is_502(nvd):
+    async def oversize():
+        # chunked, no content-length: only the streamed byte count can catch it
+        for _ in range(30):
+            yield b" " * 10_000
+        yield orjson.dumps(NVD_BODY)
+
+    nvd["handler"] = lambda request: httpx.Response(200, content=oversize())
+    async with api_client() as client:
+        r = await client.post("/triage", json={"target": "example.com"})
+
+    assert r.status_code == 502
+    assert nvd["calls"] == 1
+
+
+def test_stub_mode_does_not_need_the_http_client(monkeypatch):
+    # no startup hook, so app.state.http was never created
+    monkeypatch.setattr(main, "STUB_MODE", True)
+    monkeypatch.setattr(main, "TRIAGE_POLICY", "triage_stub")
+    monkeypatch.setattr(main, "CVE_SOURCE", "stub-cve")
+    monkeypatch.setattr(main, "LOW_DATA", False)
+    monkeypatch.delattr(main.app.state, "http", raising=False)
+    r = TestClient(main.app).post("/triage", json={"target": "stub-only.example"})
+
+    assert r.status_code == 200
+    assert r.json()["sources"][0]["tool"] == "stub-cve"
+
+
+@pytest.mark.asyncio
+async def test_cve_list_is_capped_even_if_upstream_ignores_limit(nvd):
+    many = {"vulnerabilities": NVD_BODY["vulnerabilities"] * 12}
+    nvd["handler"] = lambda request: httpx.Response(200, json=many)
+    async with api_client() as client:
+        r = await client.post("/triage", json={"target": "example.com", "depth": "standard"})
+
+    assert r.status_code == 200
+    assert len(r.json()["cves"]) == 8
+
+
+@pytest.mark.asyncio
+async def test_nvd_record_parsing(nvd):
+    def record(cve_id, metrics=None, descriptions=({"value": "Example issue"},)):
+        cve = {"id": cve_id, "descriptions": list(descriptions)}
+        if metrics is not None:
+            cve["metrics"] = metrics
+        return {"cve": cve}
+
+    body = {
+        "vulnerabilities": [
+            record("CVE-V31", {"cvssMetricV31": [{"cvssData": {"baseScore": 9.8, "baseSeverity": "CRITICAL"}}]}),
+            record("CVE-V2", {"cvssMetricV2": [{"cvssData": {"baseScore": 7.5}}]}),
+            record("CVE-V2-LEGACY", {"cvssMetricV2": [{"baseScore": 5.0}]}),
+            record("CVE-V2-NOSCORE", {"cvssMetricV2": [{}]}),
+            record("CVE-NOMETRICS", descriptions=()),
+            {"cve": {"descriptions": [{"value": "no id"}]}},
+        ]
+    }
+    nvd["handler"] = lambda request: httpx.Response(200, json=body)
+
+    items = await main._lookup_cves_nvd(main.app.state.http, "example", 10)
+
+    assert items == [
+        {"cve_id": "CVE-V31", "cvss": 9.8, "summary": "Example issue", "severity": "Critical"},
+        {"cve_id": "CVE-V2", "cvss": 7.5, "summary": "Example issue", "severity": "High"},
+        {"cve_id": "CVE-V2-LEGACY", "cvss": 5.0, "summary": "Example issue", "severity": "Medium"},
+        {"cve_id": "CVE-V2-NOSCORE", "cvss": 0.0, "summary": "Example issue", "severity": "Medium"},
+        {"cve_id": "CVE-NOMETRICS", "cvss": 0.0, "summary": "N/A", "severity": "Unknown"},
+    ]
+
+
+def test_triage_sends_etag_and_honours_if_none_match(stub):
+    first = stub.post("/triage", json={"target": "example.com"})
+    etag = first.headers["etag"]
+    assert first.status_code == 200
+    assert first.json()["assets"] == ["example.com"]
+
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        r = stub.post("/triage", json={"target": "example.com"}, headers={"If-None-Match": header})
+        assert r.status_code == 304, header
+        assert r.content == b""
+        assert r.headers["etag"] == etag
+
+    miss = stub.post("/triage", json={"target": "example.com"}, headers={"If-None-Match": '"other"'})
+    assert miss.status_code == 200
+    assert miss.content == first.content
+
+
+def test_cache_ttl_tiers(stub, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main, "cache", TLRUCache(maxsize=16, ttu=main._cache_ttu, timer=lambda: clock[0]))
+
+    health = stub.get("/health").content
+    triage = stub.post("/triage", json={"target": "example.com"}).content
+
+    clock[0] += 3  # past the 2 s /health tier, well inside the 1 h stub tier
+    assert stub.get("/health").content != health
+    assert stub.post("/triage", json={"target": "example.com"}).content == triage
+
+    clock[0] += 3600
+    assert stub.post("/triage", json={"target": "example.com"}).content != triage
+
+    assert main._cache_ttu("triage_nvd:example.com:quick:True", None, 0.0) == 300